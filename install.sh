@@ -60,10 +60,8 @@ EOF
     # I have used "gemini-2.0-flash-lite-preview" which is the current fast model.
     # You can edit settings.json later if 2.5 becomes available.
 
-    # Create memory file
-    if [ ! -f "memory.json" ]; then
-        echo "{}" > memory.json
-    fi
+    # memory.jsonl is created by the bot on the first "remember"; an existing
+    # memory.json from older versions is migrated into it on first start
 
     echo "Installation complete."
     read -p "Press Enter to return to menu..."
@@ -1,11 +1,49 @@
 import discord
 import asyncio
 import aiohttp
+import hashlib
 import json
 import os
 import logging
+import mmap
+import re
 import sys
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from datetime import datetime
+from itertools import dropwhile
+
+# --- JSON HELPERS ---
+# Picked once at import: orjson, then ujson, then stdlib json.
+# json_loads takes bytes and json_dumps returns bytes for every backend,
+# so files can always be opened in binary mode.
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    orjson = None
+    try:
+        import ujson
+        json_loads = ujson.loads
+        def json_dumps(obj): return ujson.dumps(obj).encode()
+    except ImportError:
+        json_loads = json.loads
+        def json_dumps(obj): return json.dumps(obj, separators=(',', ':')).encode()
+
+# Below this size a plain read is cheaper than setting up a mapping
+MMAP_THRESHOLD = 64 * 1024
+
+def read_json_file(path):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not orjson or size < MMAP_THRESHOLD:
+            return json_loads(f.read())
+        # orjson parses straight from the mapped pages, skipping a bytes copy
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                return orjson.loads(view)
 
 # --- PRODUCTION LOGGING SETUP ---
 # Logs are written to vito.log file and stdout
@@ -13,7 +51,7 @@ logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
     handlers=[
-        logging.FileHandler("vito.log"),
+        logging.FileHandler("vito.log", encoding="utf-8", delay=True),
         logging.StreamHandler(sys.stdout)
     ]
 )
@@ -22,12 +60,13 @@ logger = logging.getLogger("Vito")
 # --- CONFIGURATION LOADER ---
 def load_config():
     try:
-        with open('settings.json', 'r') as f:
-            return json.load(f)
+        with open('settings.json', 'rb') as f:
+            return json_loads(f.read())
     except FileNotFoundError:
         logger.critical("settings.json not found! Run install.sh first.")
         sys.exit(1)
-    except json.JSONDecodeError:
+    except ValueError:
+        # json.JSONDecodeError and orjson.JSONDecodeError both subclass ValueError
         logger.critical("settings.json is corrupted. Please check your commas and quotes.")
         sys.exit(1)
 
@@ -37,7 +76,11 @@ settings = load_config()
 CREATOR_ID = int(settings.get('creator_id', 0) or 0)
 # Handle admin_ids being empty or malformed more robustly
 admin_ids_raw = settings.get('admin_ids', "")
-ADMIN_IDS = [int(x.strip()) for x in str(admin_ids_raw).split(',') if x.strip().isdigit()]
+# frozenset so the per-message priority check is an O(1) lookup
+ADMIN_IDS = frozenset(int(x.strip()) for x in str(admin_ids_raw).split(',') if x.strip().isdigit())
+# Precomputed priority levels: Creator 3, Admins 2, everyone else 1.
+# Creator goes last so it wins if also listed as an admin.
+PRIORITY = {**{admin_id: 2 for admin_id in ADMIN_IDS}, CREATOR_ID: 3}
 
 DISCORD_TOKEN = settings.get('discord_token', "").strip()
 GEMINI_KEY = settings.get('gemini_key', "").strip()
@@ -51,30 +94,247 @@ if not DISCORD_TOKEN or not GEMINI_KEY:
     logger.critical("Missing API Keys in settings.json.")
     sys.exit(1)
 
+# --- STATIC REQUEST TARGETS ---
+# Each provider gets its own session (see setup_hook), so paths are relative
+# to that session's base URL. The model and key are fixed at boot, so the
+# paths are built once. Gemini is called through its SSE streaming endpoint
+# so replies can be shown as they generate.
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com"
+GEMINI_PATH = f"/v1beta/models/{GEMINI_MODEL}:streamGenerateContent?alt=sse&key={GEMINI_KEY}"
+OPENROUTER_BASE_URL = "https://openrouter.ai"
+OPENROUTER_PATH = "/api/v1/chat/completions"
+
+# --- STATIC REQUEST HEADERS ---
+# Request bodies are pre-encoded with json_dumps, so the content type is set here
+GEMINI_HEADERS = {"Content-Type": "application/json"}
+OPENROUTER_HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_KEY}",
+    "Content-Type": "application/json",
+    "HTTP-Referer": "https://discord.com",
+    "X-Title": "Vito Bot"
+}
+
+# --- RESPONSE CACHE ---
+# Identical request bodies (same model, prompt, memories and history) get
+# the stored reply instead of a new API round-trip. Search-grounded Gemini
+# calls are never cached since their answers depend on live web results.
+RESPONSE_CACHE_SIZE = 512
+
 # --- SYSTEM PROMPT ---
 BASE_SYSTEM_PROMPT = """Your name is Vito. You were created by Yoruboku.
 """
 
+# Payload fragments that never change, built once instead of per request.
+# The base prompt ones are used as-is for users without saved memories.
+GEMINI_GENERATION_CONFIG = {"temperature": 0.7, "maxOutputTokens": 2000}
+GEMINI_PAYLOAD_SKELETON = {"generationConfig": GEMINI_GENERATION_CONFIG}
+BASE_SYSTEM_INSTRUCTION = {"parts": [{"text": BASE_SYSTEM_PROMPT}]}
+BASE_SYSTEM_MESSAGE = {"role": "system", "content": BASE_SYSTEM_PROMPT}
+SYSTEM_FRAGMENT_CACHE_SIZE = 256  # distinct rendered system prompts kept
+
+# Every failure reply from call_gemini/call_openrouter starts with one of these
+ERROR_REPLY_PREFIXES = ("Error:", "Gemini Error", "OpenRouter Error")
+
 # --- MEMORY SYSTEM ---
-MEMORY_FILE = 'memory.json'
+MEMORY_FILE = 'memory.jsonl'
+LEGACY_MEMORY_FILE = 'memory.json'  # Pre-JSONL format, migrated on first load
+CONTEXT_TTL = 3600.0  # seconds; compared against time.monotonic()
+CONTEXT_SWEEP_INTERVAL = 600  # seconds between background stale-context sweeps
+MAX_HISTORY_TURNS = 40  # turns kept per user (and so sent upstream per request)
 context_store = {}
+user_locks = defaultdict(asyncio.Lock)  # One in-flight request per user
+
+def memory_record(user_id, entry):
+    return json_dumps({"uid": str(user_id), "m": entry}) + b"\n"
+
+# Memories live in an append-only JSONL log, one {"uid", "m"} record per line.
+# The log is replayed into RAM on first use and only re-read if the file is
+# changed outside the bot; saving a memory appends a single line to it.
+class MemoryStore:
+    def __init__(self, path, legacy_path=None):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.data = None
+        self.mtime = None
+        self.version = 0  # Bumped on every add, to detect adds racing a reload
+        self.write_lock = threading.Lock()  # Writes run in worker threads
+        self.load_lock = asyncio.Lock()  # One replay (and migration) at a time
+
+    def _read(self):
+        # A missing or empty log may still have an old memory.json to import
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return self._migrate_legacy()
+        data = {}
+        try:
+            with open(self.path, 'rb') as f:
+                self._replay(f, data)
+        except Exception as e:
+            logger.error("Failed to load memory: %s", e)
+        return data
 
-def load_lt_memory():
-    if not os.path.exists(MEMORY_FILE): return {}
-    try:
-        with open(MEMORY_FILE, 'r') as f: return json.load(f)
-    except Exception as e:
-        logger.error(f"Failed to load memory: {e}")
-        return {}
-
-def save_lt_memory(data):
-    # Atomic write to prevent corruption during crash
-    temp_file = MEMORY_FILE + ".tmp"
-    try:
-        with open(temp_file, 'w') as f: json.dump(data, f, indent=4)
-        os.replace(temp_file, MEMORY_FILE)
-    except Exception as e:
-        logger.error(f"Failed to save memory: {e}")
+    def _replay(self, lines, data):
+        for line in lines:
+            if not line.strip(): continue
+            try:
+                record = json_loads(line)
+                uid, entry = record['uid'], record['m']
+                data.setdefault(uid, []).append(entry)
+            except (ValueError, KeyError, TypeError):
+                # e.g. a line cut short by a crash mid-append, or valid JSON
+                # that isn't a memory record; skip just that line
+                logger.warning("Skipping corrupt record in %s", self.path)
+        return data
+
+    def _migrate_legacy(self):
+        # One-time upgrade from the old single-document memory.json
+        if not self.legacy_path or not os.path.exists(self.legacy_path): return {}
+        try:
+            data = read_json_file(self.legacy_path)
+        except Exception as e:
+            logger.error("Failed to load legacy memory: %s", e)
+            return {}
+        snapshot = b"".join(memory_record(uid, m) for uid, mems in data.items() for m in mems)
+        # Atomic write so a crash can't leave a half-migrated log behind
+        temp_file = self.path + ".tmp"
+        try:
+            with self.write_lock:
+                # Lines appended while memory.json was parsing are kept after
+                # the imported ones instead of being replaced by the snapshot
+                existing = b""
+                if os.path.exists(self.path):
+                    with open(self.path, 'rb') as f: existing = f.read()
+                if existing and not existing.endswith(b"\n"): existing += b"\n"
+                with open(temp_file, 'wb') as f: f.write(snapshot + existing)
+                os.replace(temp_file, self.path)
+            logger.info("Migrated %s to %s", self.legacy_path, self.path)
+        except Exception as e:
+            logger.error("Failed to migrate memory: %s", e)
+            return data
+        return self._replay(existing.splitlines(), data)
+
+    def _append(self, line):
+        try:
+            with self.write_lock:
+                with open(self.path, 'a+b') as f:
+                    # If a crash cut the last record short, start on a fresh line
+                    end = f.seek(0, os.SEEK_END)
+                    if end:
+                        f.seek(end - 1)
+                        if f.read(1) != b"\n": line = b"\n" + line
+                    f.write(line)
+                self.mtime = self._disk_mtime()  # Our own write isn't an external edit
+        except Exception as e:
+            logger.error("Failed to save memory: %s", e)
+
+    def _disk_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    async def _load(self):
+        # A stat per call is far cheaper than a replay; only re-read when
+        # the log was edited outside the bot
+        if self.data is not None and self._disk_mtime() == self.mtime: return self.data
+        # Single-flight: callers arriving mid-replay wait for it rather than
+        # starting their own, so two migrations can never race each other
+        async with self.load_lock:
+            mtime = self._disk_mtime()
+            if self.data is None or mtime != self.mtime:
+                version = self.version
+                # Parse in a thread so a large file doesn't block the event loop
+                data = await asyncio.to_thread(self._read)
+                # Another caller may have added an entry while we were reading
+                if version == self.version:
+                    self.data = data
+                    self.mtime = mtime
+        return self.data
+
+    async def get(self, user_id):
+        return (await self._load()).get(str(user_id), [])
+
+    async def add(self, user_id, entry):
+        (await self._load()).setdefault(str(user_id), []).append(entry)
+        self.version += 1
+        # O(1 line) on disk, written straight away in a worker thread
+        await asyncio.to_thread(self._append, memory_record(user_id, entry))
+
+lt_memory = MemoryStore(MEMORY_FILE, LEGACY_MEMORY_FILE)
+
+def prune_contexts():
+    # Called from the bot's background sweeper, never on the message path
+    cutoff = time.monotonic() - CONTEXT_TTL
+    for uid in [uid for uid, ctx in context_store.items() if ctx['last_active'] < cutoff]:
+        del context_store[uid]
+        if uid in user_locks and not user_locks[uid].locked():
+            del user_locks[uid]
+
+def new_history():
+    # Bounded so memory, payload size and token cost stay O(MAX_HISTORY_TURNS)
+    return deque(maxlen=MAX_HISTORY_TURNS)
+
+def trim_history(history):
+    # The deque already holds only the newest turns; once old turns fall off
+    # the front it may open on a model turn, which the window must not
+    return list(dropwhile(lambda turn: turn['role'] != 'user', history))
+
+def to_gemini_turn(turn):
+    # History uses OpenAI-style turns; Gemini wants role "model" and text parts
+    role = "user" if turn['role'] == "user" else "model"
+    return {"role": role, "parts": [{"text": turn['content']}]}
+
+def reset_history(ctx):
+    # Two parallel deques of equal length, one per API shape, so each turn is
+    # converted once when it arrives instead of on every API call
+    ctx['history'] = new_history()         # chat-completions shape (OpenRouter)
+    ctx['history_gemini'] = new_history()  # Gemini "contents" shape
+
+def append_turn(ctx, role, text):
+    turn = {"role": role, "content": text}
+    ctx['history'].append(turn)
+    ctx['history_gemini'].append(to_gemini_turn(turn))
+
+# --- STREAMED REPLIES ---
+DISCORD_LIMIT = 2000  # Discord's max message length
+DISCORD_CHUNK = 1900  # Split size for longer replies, safely under the limit
+STREAM_EDIT_INTERVAL = 1.0  # Min seconds between in-place edits while streaming
+
+class StreamingReply:
+    # Shows a reply while it is still generating: the first text goes out at
+    # once as a reply, then messages are edited in place at most once per
+    # interval. Text past DISCORD_LIMIT is split into DISCORD_CHUNK pieces
+    # that continue in follow-up messages.
+    def __init__(self, message):
+        self.message = message
+        self.sent = []
+        self.last_render = 0.0
+
+    async def update(self, text):
+        if self.sent and time.monotonic() - self.last_render < STREAM_EDIT_INTERVAL: return
+        await self.render(text)
+
+    async def render(self, text):
+        self.last_render = time.monotonic()
+        if len(text) <= DISCORD_LIMIT:
+            chunks = [text] if text else []
+        else:
+            chunks = [text[i:i + DISCORD_CHUNK] for i in range(0, len(text), DISCORD_CHUNK)]
+        for idx, chunk in enumerate(chunks):
+            if idx < len(self.sent):
+                if self.sent[idx].content != chunk:
+                    self.sent[idx] = await self.sent[idx].edit(content=chunk)
+            elif idx == 0:
+                self.sent.append(await self.message.reply(chunk, mention_author=True))
+            else:
+                # Sent one after another so chunks can't arrive out of order;
+                # discord.py's HTTP client already handles 429 backoff
+                self.sent.append(await self.message.channel.send(chunk))
+        # The final text can need fewer messages than a partial one did
+        # (e.g. an error after a long partial reply): drop the leftovers
+        for stale in self.sent[len(chunks):]:
+            try: await stale.delete()
+            except discord.HTTPException: pass
+        del self.sent[len(chunks):]
 
 # --- BOT CLASS ---
 class VitoBot(discord.Client):
@@ -82,50 +342,133 @@ class VitoBot(discord.Client):
         intents = discord.Intents.default()
         intents.message_content = True
         super().__init__(intents=intents)
-        self.session = None
+        self.gemini_session = None
+        self.openrouter_session = None
+        self.context_sweeper = None
         self.active_tasks = {}
+        self.response_cache = OrderedDict()
+        self.gemini_sys_cache = {BASE_SYSTEM_PROMPT: BASE_SYSTEM_INSTRUCTION}
+        self.sys_prompt_cache = {}  # user_id -> (memory signature, rendered prompt)
+        self.mention_re = None
 
     async def setup_hook(self):
-        # Persistent Session for Speed
-        self.session = aiohttp.ClientSession()
+        # self.user is known once login() runs setup_hook. Matches both the
+        # plain <@id> and the nickname <@!id> mention forms.
+        self.mention_re = re.compile(rf'<@!?{self.user.id}>')
+
+        # Persistent Sessions for Speed, one per provider so a slow provider
+        # can't starve the other's connection pool
+        # Timeouts so a hung API call can't hold a user's task forever. Gemini
+        # streams, so only a stalled socket counts: a long healthy reply can
+        # take as long as it needs. OpenRouter answers in one piece.
+        self.gemini_session = self.make_session(GEMINI_BASE_URL, aiohttp.ClientTimeout(total=None, connect=10, sock_read=60))
+        self.openrouter_session = self.make_session(OPENROUTER_BASE_URL, aiohttp.ClientTimeout(total=60, connect=10))
+        self.context_sweeper = asyncio.create_task(self.sweep_contexts_loop())
 
     async def close(self):
-        if self.session: await self.session.close()
+        if self.context_sweeper: self.context_sweeper.cancel()
+        if self.gemini_session: await self.gemini_session.close()
+        if self.openrouter_session: await self.openrouter_session.close()
         await super().close()
 
+    def make_session(self, base_url, timeout):
+        # Keep-alive pool + DNS cache so repeat calls skip the TCP/TLS handshake.
+        connector = aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=32,
+            keepalive_timeout=75,
+            ttl_dns_cache=300,
+            enable_cleanup_closed=True
+        )
+        return aiohttp.ClientSession(
+            base_url=base_url,
+            connector=connector,
+            timeout=timeout
+        )
+
+    async def sweep_contexts_loop(self):
+        while True:
+            await asyncio.sleep(CONTEXT_SWEEP_INTERVAL)
+            prune_contexts()
+            # Rendered prompts are only worth keeping for users still chatting
+            for uid in [uid for uid in self.sys_prompt_cache if uid not in context_store]:
+                del self.sys_prompt_cache[uid]
+
     async def on_ready(self):
-        logger.info(f"--- VITO IS ONLINE ---")
-        logger.info(f"User: {self.user}")
-        logger.info(f"Gemini Model: {GEMINI_MODEL}")
+        logger.info("--- VITO IS ONLINE ---")
+        logger.info("User: %s", self.user)
+        logger.info("Gemini Model: %s", GEMINI_MODEL)
         context_store.clear()
 
+    def system_prompt_for(self, user_id, user_mem):
+        if not user_mem: return BASE_SYSTEM_PROMPT
+        # Memories rarely change between turns, so reuse the rendered prompt
+        # while they're the same. Returning the same str object also means
+        # its hash is already computed for the gemini_sys_cache lookup.
+        mem_sig = hash(tuple(user_mem))
+        cached = self.sys_prompt_cache.get(user_id)
+        if cached and cached[0] == mem_sig:
+            return cached[1]
+        rendered = BASE_SYSTEM_PROMPT + "\n\n[USER MEMORIES]:\n" + "\n".join([f"- {m}" for m in user_mem])
+        self.sys_prompt_cache[user_id] = (mem_sig, rendered)
+        return rendered
+
+    # --- RESPONSE CACHE (LRU) ---
+    def cache_key(self, mode, body):
+        return mode, hashlib.blake2b(body, digest_size=16).digest()
+
+    def cache_get(self, key):
+        text = self.response_cache.get(key)
+        if text is not None:
+            self.response_cache.move_to_end(key)
+        return text
+
+    def cache_put(self, key, text):
+        self.response_cache[key] = text
+        self.response_cache.move_to_end(key)
+        if len(self.response_cache) > RESPONSE_CACHE_SIZE:
+            self.response_cache.popitem(last=False)
+
+    def gemini_system_part(self, system_instruction):
+        # A user's system prompt rarely changes between turns, so reuse its
+        # {"parts": [...]} wrapper; reset wholesale if it grows too large
+        sys_part = self.gemini_sys_cache.get(system_instruction)
+        if sys_part is None:
+            if len(self.gemini_sys_cache) >= SYSTEM_FRAGMENT_CACHE_SIZE:
+                self.gemini_sys_cache.clear()
+            sys_part = {"parts": [{"text": system_instruction}]}
+            self.gemini_sys_cache[system_instruction] = sys_part
+        return sys_part
+
     # --- API CALLS (FAIL FAST) ---
-    async def call_gemini(self, history, system_instruction, use_search=False):
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent?key={GEMINI_KEY}"
+    async def call_gemini(self, history, system_instruction, use_search=False, on_text=None):
+        # history is the Gemini-shaped deque (ctx['history_gemini'])
+        # on_text, if given, is awaited with the accumulated reply after each streamed chunk
+        url = GEMINI_PATH
         
-        payload = {
-            "contents": history,
-            "system_instruction": {"parts": [{"text": system_instruction}]},
-            "generationConfig": {
-                "temperature": 0.7,
-                "maxOutputTokens": 2000
-            }
-        }
+        payload = dict(GEMINI_PAYLOAD_SKELETON)
+        payload["contents"] = trim_history(history)
+        payload["system_instruction"] = self.gemini_system_part(system_instruction)
         
         # --- GOOGLE SEARCH GROUNDING IMPLEMENTATION ---
         if use_search:
             payload['tools'] = [{"google_search": {}}]
             # Log the specific query being searched for better debugging
             last_msg = history[-1]['parts'][0]['text'] if history else "Unknown"
-            logger.info(f"Payload set with google_search tool. Query: '{last_msg}'")
+            logger.info("Payload set with google_search tool. Query: '%s'", last_msg)
+
+        body = json_dumps(payload)
+        key = None if use_search else self.cache_key("gemini", body)
+        cached = self.cache_get(key) if key else None
+        if cached is not None: return cached
 
         try:
-            async with self.session.post(url, json=payload) as response:
+            async with self.gemini_session.post(url, headers=GEMINI_HEADERS, data=body) as response:
                 
                 if response.status != 200:
                     error_text = await response.text()
                     # Log the specific API error, including the 429 status
-                    logger.error(f"Gemini API FAILED ({response.status}). URL: {url}. Details: {error_text}")
+                    logger.error("Gemini API FAILED (%d). URL: %s. Details: %s", response.status, url, error_text)
                     
                     if response.status == 429:
                         return "Gemini Error 429: Rate limit exceeded. Try again later."
@@ -133,118 +476,161 @@ class VitoBot(discord.Client):
                         return f"Gemini Error 404: Model '{GEMINI_MODEL}' not found. Check settings.json."
                     return f"Gemini Error {response.status}. Check vito.log for details."
                 
-                # Success path
-                data = await response.json()
-                
-                # Check for grounded content and inform user/log source
+                # Success path: each SSE frame is a partial GenerateContentResponse
                 output_text = ""
-                try:
-                    output_text = data['candidates'][0]['content']['parts'][0]['text']
-                    
-                    # Enhanced logging to show if grounding was actually used
-                    if use_search:
-                        # Check if groundingMetadata exists
-                        candidate = data.get('candidates', [{}])[0]
-                        grounding_metadata = candidate.get('groundingMetadata')
-                        
-                        if grounding_metadata:
-                            sources = grounding_metadata.get('groundingAttributions', [])
-                            source_uris = [s['web']['uri'] for s in sources if 'web' in s and 'uri' in s['web']]
-                            if source_uris:
-                                logger.info(f"Search Grounding SUCCESS. Sources used: {len(source_uris)}")
-                            else:
-                                logger.info("Search tool requested, result returned but no specific web sources cited.")
-                                # If no sources cited for a search query, it might be vague.
-                                if "I cannot" in output_text or "Please specify" in output_text:
-                                    output_text += "\n\n*(Tip: Try a more specific search query for better results.)*"
-                        else:
-                            logger.warning("Search tool requested, but no grounding metadata found in response.")
-                        
-                    return output_text
-                    
-                except (KeyError, IndexError):
+                grounding_metadata = None
+                async for line in response.content:
+                    if not line.startswith(b"data:"): continue
+                    frame = json_loads(line[5:])
+                    candidate = (frame.get('candidates') or [{}])[0]
+                    for part in candidate.get('content', {}).get('parts', []):
+                        output_text += part.get('text', '')
+                    # Grounding data arrives with the final frames
+                    grounding_metadata = candidate.get('groundingMetadata') or grounding_metadata
+                    if on_text and output_text:
+                        # A Discord failure here is not a Gemini failure: log it,
+                        # stop live updates and let the stream finish
+                        try:
+                            await on_text(output_text)
+                        except Exception as e:
+                            logger.warning("Streamed reply update failed: %s", e)
+                            on_text = None
+
+                if not output_text:
                     return "Error: Gemini returned an empty response."
 
+                # Enhanced logging to show if grounding was actually used
+                if use_search:
+                    if grounding_metadata:
+                        sources = grounding_metadata.get('groundingAttributions', [])
+                        source_uris = [s['web']['uri'] for s in sources if 'web' in s and 'uri' in s['web']]
+                        if source_uris:
+                            logger.info("Search Grounding SUCCESS. Sources used: %d", len(source_uris))
+                        else:
+                            logger.info("Search tool requested, result returned but no specific web sources cited.")
+                            # If no sources cited for a search query, it might be vague.
+                            if "I cannot" in output_text or "Please specify" in output_text:
+                                output_text += "\n\n*(Tip: Try a more specific search query for better results.)*"
+                    else:
+                        logger.warning("Search tool requested, but no grounding metadata found in response.")
+
+                if key: self.cache_put(key, output_text)
+                return output_text
+
         except Exception as e:
-            logger.error(f"Gemini Connection Failed: {e}")
+            logger.error("Gemini Connection Failed: %s", e)
             return "Error: Could not connect to Gemini."
 
 
     async def call_openrouter(self, messages, system_instruction):
-        url = "https://openrouter.ai/api/v1/chat/completions"
+        url = OPENROUTER_PATH
         
-        formatted_msgs = [{"role": "system", "content": system_instruction}]
-        for msg in messages:
-            role = "user" if msg['role'] == "user" else "assistant"
-            # Ensure msg parts exists and has text before accessing
-            if msg.get('parts') and len(msg['parts']) > 0 and msg['parts'][0].get('text'):
-                formatted_msgs.append({"role": role, "content": msg['parts'][0]['text']})
-
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_KEY}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://discord.com",
-            "X-Title": "Vito Bot"
-        }
+        if system_instruction == BASE_SYSTEM_PROMPT:
+            sys_msg = BASE_SYSTEM_MESSAGE
+        else:
+            sys_msg = {"role": "system", "content": system_instruction}
+        # History is already stored in chat-completions shape; no reshaping needed
+        formatted_msgs = [sys_msg, *trim_history(messages)]
+
         payload = {"model": OPENROUTER_MODEL, "messages": formatted_msgs, "temperature": 0.7}
+
+        body = json_dumps(payload)
+        key = self.cache_key("openrouter", body)
+        cached = self.cache_get(key)
+        if cached is not None: return cached
         
         try:
-            async with self.session.post(url, headers=headers, json=payload) as response:
+            async with self.openrouter_session.post(url, headers=OPENROUTER_HEADERS, data=body) as response:
                     
                 if response.status != 200:
                     text = await response.text()
-                    logger.error(f"OpenRouter API FAILED ({response.status}). Details: {text}")
+                    logger.error("OpenRouter API FAILED (%d). Details: %s", response.status, text)
                     
                     if response.status == 429:
                         return "OpenRouter Error 429: Rate limit exceeded. Try again later."
                     return f"OpenRouter Error {response.status}. Check vito.log for details."
                 
-                data = await response.json()
-                return data['choices'][0]['message']['content']
+                data = json_loads(await response.read())
+                output_text = data['choices'][0]['message']['content']
+                # content can be empty or null (e.g. a filtered reply); a blank
+                # reply would send nothing to Discord and land in history
+                if not output_text:
+                    return "Error: OpenRouter returned an empty response."
+                self.cache_put(key, output_text)
+                return output_text
             
         except Exception as e:
-            logger.error(f"OpenRouter Request Failed: {e}")
+            logger.error("OpenRouter Request Failed: %s", e)
             return "Error: Could not connect to OpenRouter."
+
+    async def call_fastest(self, gemini_history, history, system_instruction, use_search=False):
+        # Race Gemini against OpenRouter and keep the first successful reply;
+        # the slower call is cancelled. Costs both requests, saves tail latency.
+        if not OPENROUTER_KEY:
+            return await self.call_gemini(gemini_history, system_instruction, use_search=use_search)
+
+        tasks = [
+            asyncio.create_task(self.call_gemini(gemini_history, system_instruction, use_search=use_search)),
+            asyncio.create_task(self.call_openrouter(history, system_instruction))
+        ]
+        first_error = None
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    response_text = task.result()
+                    if not response_text.startswith(ERROR_REPLY_PREFIXES):
+                        return response_text
+                    first_error = first_error or response_text
+            # Both providers failed; report whichever failed first
+            return first_error
+        finally:
+            for task in tasks: task.cancel()
         
 
 client = VitoBot()
 
 # --- MESSAGE HANDLING ---
 def get_priority(user_id):
-    if user_id == CREATOR_ID: return 3
-    if user_id in ADMIN_IDS: return 2
-    return 1
+    return PRIORITY.get(user_id, 1)
 
 @client.event
 async def on_message(message):
-    if message.author == client.user: return
-    
-    is_mentioned = client.user in message.mentions
-    is_reply = (message.reference and client.user in message.mentions)
+    # Fast path: most traffic is other bots (incl. ourselves) or unrelated
+    # chatter, so bail out before doing any other work
+    if message.author.bot: return
 
     # Check if the message is a direct message to the bot
     is_dm = isinstance(message.channel, discord.DMChannel)
+    # message.mentions (unlike raw_mentions) also covers reply pings
+    is_mentioned = client.user in message.mentions
     
-    if not (is_mentioned or is_reply or is_dm): return
+    if not (is_mentioned or is_dm): return
+
+    is_reply = message.reference is not None and is_mentioned
 
     # 1. PARSE INPUT
-    raw_content = message.content.replace(f'<@{client.user.id}>', '').strip()
+    raw_content = client.mention_re.sub('', message.content).strip()
     user_id = message.author.id
 
     # Handle replied-to messages to include their content in the prompt
     if is_reply and message.reference:
         try:
-            # Fetch the replied-to message
-            replied_message = await message.channel.fetch_message(message.reference.message_id)
-            replied_content = replied_message.content.replace(f'<@{client.user.id}>', '').strip()
+            # Discord usually ships the replied-to message with the event;
+            # only fall back to an API fetch when it wasn't resolved
+            replied_message = message.reference.cached_message or message.reference.resolved
+            if not isinstance(replied_message, discord.Message):
+                replied_message = await message.channel.fetch_message(message.reference.message_id)
+            replied_content = client.mention_re.sub('', replied_message.content).strip()
             
             # Prepend the old message's content to the new one
             raw_content = f"{replied_content}\n{raw_content}"
             
         except discord.NotFound:
-            logger.warning(f"Could not find replied to message with ID: {message.reference.message_id}")
+            logger.warning("Could not find replied to message with ID: %s", message.reference.message_id)
         except Exception as e:
-            logger.error(f"Error fetching replied message: {e}")
+            logger.error("Error fetching replied message: %s", e)
 
     parts = raw_content.split(' ', 1)
     cmd = parts[0].lower() if parts else ""
@@ -266,17 +652,17 @@ async def on_message(message):
                     client.active_tasks[target_id].cancel()
                     await message.reply(f"Admin Force Stop applied to <@{target_id}>.", mention_author=True)
             except Exception as e:
-                logger.error(f"Error during admin stop: {e}")
+                logger.error("Error during admin stop: %s", e)
         return
 
     # 3. CONTEXT & MEMORY SETUP
-    now = datetime.now()
-    if user_id not in context_store or (now - context_store[user_id]['last_active'] > timedelta(hours=1)):
-        context_store[user_id] = {'last_active': now, 'history': []}
+    now = time.monotonic()
+    if user_id not in context_store or (now - context_store[user_id]['last_active'] > CONTEXT_TTL):
+        context_store[user_id] = {'last_active': now}
+        reset_history(context_store[user_id])
     context_store[user_id]['last_active'] = now
 
-    memories = load_lt_memory()
-    user_mem = memories.get(str(user_id), [])
+    user_mem = await lt_memory.get(user_id)
 
     # 4. COMMAND ROUTING
     mode = "gemini"
@@ -284,7 +670,7 @@ async def on_message(message):
     use_search = True # Default: All Gemini requests use search grounding
 
     if cmd == "newchat":
-        context_store[user_id]['history'] = []
+        reset_history(context_store[user_id])
         await message.reply("Context cleared.", mention_author=True)
         return
 
@@ -308,17 +694,16 @@ async def on_message(message):
             await asyncio.sleep(5)
             await feedback_msg.delete()
         except discord.Forbidden:
-            logger.warning(f"Missing 'Manage Messages' permission in channel {message.channel.id}")
+            logger.warning("Missing 'Manage Messages' permission in channel %s", message.channel.id)
         except Exception as e:
-            logger.error(f"Error during purge command: {e}")
+            logger.error("Error during purge command: %s", e)
         return
 
     elif cmd == "remember":
         if not args: return await message.reply("Usage: @Vito remember [text]", mention_author=True)
         timestamp = datetime.now().strftime("%Y-%m-%d")
-        user_mem.append(f"[{timestamp}] {args}")
-        memories[str(user_id)] = user_mem
-        save_lt_memory(memories)
+        await lt_memory.add(user_id, f"[{timestamp}] {args}")
+        client.sys_prompt_cache.pop(user_id, None)
         await message.reply("Memory saved to database.", mention_author=True)
         return
 
@@ -326,53 +711,55 @@ async def on_message(message):
         mode = "openrouter"
         final_prompt = args if args else " "
         use_search = False # OpenRouter mode does not use Gemini search
+
+    elif cmd == "race":
+        mode = "race"
+        final_prompt = args if args else " "
         
     # 5. SYSTEM PROMPT CONSTRUCTION (for memory injection)
-    current_sys = BASE_SYSTEM_PROMPT
-    if user_mem:
-        current_sys += "\n\n[USER MEMORIES]:\n" + "\n".join([f"- {m}" for m in user_mem])
+    current_sys = client.system_prompt_for(user_id, user_mem)
 
     # 6. ASYNC EXECUTION
     async def process_request():
         try:
-            async with message.channel.typing():
-                history = context_store[user_id]['history']
-                history.append({"role": "user", "parts": [{"text": final_prompt}]})
-                
-                # API Call
-                if mode == "gemini":
-                    # Pass search flag to call_gemini
-                    response_text = await client.call_gemini(history, current_sys, use_search=use_search)
-                else:
-                    response_text = await client.call_openrouter(history, current_sys)
-                
-                # Update History
-                history.append({"role": "model", "parts": [{"text": response_text}]})
-                
-                # Split & Send
-                if len(response_text) > 2000:
-                    chunks = [response_text[i:i+1900] for i in range(0, len(response_text), 1900)]
-                    await message.reply(chunks[0], mention_author=True)
-                    for chunk in chunks[1:]:
-                        await message.channel.send(chunk)
-                        await asyncio.sleep(0.3)
-                else:
-                    await message.reply(response_text, mention_author=True)
+            # Users only wait on their own earlier request, never on each other
+            async with user_locks[user_id]:
+                client.active_tasks[user_id] = asyncio.current_task()
+                async with message.channel.typing():
+                    ctx = context_store[user_id]
+                    append_turn(ctx, "user", final_prompt)
+                    
+                    # API Call
+                    reply = StreamingReply(message)
+                    if mode == "gemini":
+                        # Pass search flag to call_gemini; partial text is shown as it streams
+                        response_text = await client.call_gemini(ctx['history_gemini'], current_sys, use_search=use_search, on_text=reply.update)
+                    elif mode == "race":
+                        response_text = await client.call_fastest(ctx['history_gemini'], ctx['history'], current_sys, use_search=use_search)
+                    else:
+                        response_text = await client.call_openrouter(ctx['history'], current_sys)
+                    
+                    # Update History
+                    append_turn(ctx, "assistant", response_text)
+                    
+                    # Final render sends whatever the stream hasn't shown yet (split to fit Discord)
+                    await reply.render(response_text)
         
         except asyncio.CancelledError:
-            logger.info(f"Task cancelled for user {user_id}")
+            logger.info("Task cancelled for user %s", user_id)
         except Exception as e:
-            logger.error(f"Unexpected Error: {e}")
+            logger.error("Unexpected Error: %s", e)
             await message.reply(f"Critical Error: {e}")
         finally:
-            if user_id in client.active_tasks:
+            # A queued request may already own the slot; only clear our own
+            if client.active_tasks.get(user_id) is asyncio.current_task():
                 del client.active_tasks[user_id]
 
-    # Register Task
-    task = asyncio.create_task(process_request())
-    client.active_tasks[user_id] = task
+    # discord.py already dispatches each on_message in its own task, so run
+    # inline; that task registers itself in active_tasks once it holds the lock
+    await process_request()
 
 try:
     client.run(DISCORD_TOKEN)
 except discord.HTTPException as e:
-    logger.critical(f"Discord Login Failed. Check your DISCORD_TOKEN. Error: {e}")
+    logger.critical("Discord Login Failed. Check your DISCORD_TOKEN. Error: %s", e)